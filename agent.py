@@ -1,7 +1,9 @@
 import asyncio
+import dataclasses
 import logging
+import os
 import re
-from pathlib import Path
+import sys
 from claude_agent_sdk import (
     AgentDefinition,
     ClaudeSDKClient,
@@ -30,11 +32,72 @@ from config import (
     IDLE_PROMPT,
     INACTIVITY_TIMEOUT_SECONDS,
 )
-from image_tools import image_mcp_server
+from image_tools import close_http_session, image_mcp_server
 
 # Set up logging
 logger = logging.getLogger("hangout")
 
+# Only "sleep" followed by a number (integer or decimal) is allowed for Bash
+_SLEEP_RE = re.compile(r"sleep\s+\d+(?:\.\d+)?")
+
+# Detects the API's "prompt is too long" error in assistant text without
+# building a lowercased copy of every block. The error is a short message, so
+# only the start of each block needs to be scanned.
+_PROMPT_TOO_LONG_RE = re.compile(r"prompt is too long", re.IGNORECASE)
+_PROMPT_TOO_LONG_SCAN_CHARS = 2048
+
+# File access tools are restricted to the data directory (resolved once)
+_FILE_TOOLS = frozenset({"Read", "Write", "Glob"})
+_ALLOWED_DIR = str(DATA_DIR.resolve())
+_ALLOWED_PREFIX = _ALLOWED_DIR + os.sep
+
+
+def _preview(text: str, limit: int) -> str:
+    """Return text truncated to limit chars, with "..." appended if cut."""
+    return text if len(text) <= limit else f"{text[:limit]}..."
+
+
+class _Truncated:
+    """Lazily stringified, truncated preview of a value for log messages.
+
+    Logging only calls __str__ when a handler actually emits the record, so
+    large tool results are never stringified for filtered-out records.
+    """
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        text = self.value if isinstance(self.value, str) else str(self.value)
+        return _preview(text, self.limit)
+
+
+# Hook responses are read-only to the SDK, so the static ones are shared
+_ALLOW: SyncHookJSONOutput = {
+    "hookSpecificOutput": {
+        "hookEventName": "PreToolUse",
+        "permissionDecision": "allow",
+    }
+}
+
+
+def _deny(reason: str) -> SyncHookJSONOutput:
+    """Build a PreToolUse response denying the tool use with a reason."""
+    return {
+        "hookSpecificOutput": {
+            "hookEventName": "PreToolUse",
+            "permissionDecision": "deny",
+            "permissionDecisionReason": reason,
+        }
+    }
+
+
+_DENY_OUTSIDE_DATA_DIR = _deny(f"Access denied: path must be within {_ALLOWED_DIR}")
+_DENY_BASH = _deny("Only 'sleep <number>' commands are allowed")
+
 
 async def pre_tool_use_hook(
     input_data: PreToolUseHookInput,
@@ -51,88 +114,44 @@ async def pre_tool_use_hook(
     """
     tool_name = input_data["tool_name"]
     tool_input = input_data["tool_input"]
-    allowed_dir = DATA_DIR.resolve()
 
     # File access tools - restrict to data directory only
-    if tool_name in ["Read", "Write", "Glob"]:
+    if tool_name in _FILE_TOOLS:
         path_str = tool_input.get("file_path") or tool_input.get("path", "")
         if not path_str:
             # Glob without path uses cwd, which is DATA_DIR - allow it
             if tool_name == "Glob":
-                return {
-                    "hookSpecificOutput": {
-                        "hookEventName": "PreToolUse",
-                        "permissionDecision": "allow",
-                    }
-                }
-            logger.warning(f"Blocked {tool_name}: no path provided")
-            return {
-                "hookSpecificOutput": {
-                    "hookEventName": "PreToolUse",
-                    "permissionDecision": "deny",
-                    "permissionDecisionReason": f"{tool_name} requires a file path",
-                }
-            }
-
-        # Resolve to absolute path
+                return _ALLOW
+            logger.warning("Blocked %s: no path provided", tool_name)
+            return _deny(f"{tool_name} requires a file path")
+
+        # Resolve to a real absolute path before checking. Relative paths are
+        # relative to the agent's cwd, which is DATA_DIR. Following symlinks
+        # keeps a link inside DATA_DIR from pointing outside it, and lets an
+        # absolute path through a symlinked DATA_DIR (or parent) match
+        # _ALLOWED_DIR, which is itself resolved.
         try:
-            requested_path = Path(path_str).resolve()
-        except Exception:
-            logger.warning(f"Invalid path in {tool_name}: {path_str}")
-            return {
-                "hookSpecificOutput": {
-                    "hookEventName": "PreToolUse",
-                    "permissionDecision": "deny",
-                    "permissionDecisionReason": f"Invalid path: {path_str}",
-                }
-            }
+            requested_path = os.path.realpath(os.path.join(_ALLOWED_DIR, path_str))
+        except (TypeError, ValueError, OSError):
+            logger.warning("Invalid path in %s: %s", tool_name, path_str)
+            return _deny(f"Invalid path: {path_str}")
 
         # Check if path is within allowed directory
-        try:
-            requested_path.relative_to(allowed_dir)
-            return {
-                "hookSpecificOutput": {
-                    "hookEventName": "PreToolUse",
-                    "permissionDecision": "allow",
-                }
-            }
-        except ValueError:
-            logger.warning(f"Blocked {tool_name} outside data dir: {path_str}")
-            return {
-                "hookSpecificOutput": {
-                    "hookEventName": "PreToolUse",
-                    "permissionDecision": "deny",
-                    "permissionDecisionReason": f"Access denied: path must be within {allowed_dir}",
-                }
-            }
+        if requested_path == _ALLOWED_DIR or requested_path.startswith(_ALLOWED_PREFIX):
+            return _ALLOW
+        logger.warning("Blocked %s outside data dir: %s", tool_name, path_str)
+        return _DENY_OUTSIDE_DATA_DIR
 
     # Bash - only allow sleep command with numeric argument
     if tool_name == "Bash":
         command = tool_input.get("command", "")
-        # Only allow "sleep" followed by a number (integer or decimal)
-        if re.fullmatch(r"sleep\s+\d+(\.\d+)?", command.strip()):
-            return {
-                "hookSpecificOutput": {
-                    "hookEventName": "PreToolUse",
-                    "permissionDecision": "allow",
-                }
-            }
-        logger.warning(f"Blocked Bash command: {command}")
-        return {
-            "hookSpecificOutput": {
-                "hookEventName": "PreToolUse",
-                "permissionDecision": "deny",
-                "permissionDecisionReason": "Only 'sleep <number>' commands are allowed",
-            }
-        }
+        if _SLEEP_RE.fullmatch(command.strip()):
+            return _ALLOW
+        logger.warning("Blocked Bash command: %s", command)
+        return _DENY_BASH
 
     # Allow all other tools (Discord MCP, WebFetch, WebSearch, image_tools MCP, etc.)
-    return {
-        "hookSpecificOutput": {
-            "hookEventName": "PreToolUse",
-            "permissionDecision": "allow",
-        }
-    }
+    return _ALLOW
 
 
 class HangoutAgent:
@@ -143,28 +162,49 @@ class HangoutAgent:
         self.session_id = self._load_session_id()
         self._client: ClaudeSDKClient | None = None  # Long-lived client instance
         self._query_in_progress = False  # Track if a query is running
-        logger.info(f"Agent initialized. Session ID: {self.session_id or 'None (new session)'}")
-        logger.debug(f"MCP Servers config: {MCP_SERVERS}")
+        self._base_options = self._build_base_options()
+        self._cached_options: ClaudeAgentOptions | None = None
+        self._cached_options_sid: object = object()  # Sentinel: never equals a session ID
+        # Dispatch table for _log_message, keyed by exact message type
+        self._log_handlers = {
+            SystemMessage: self._log_system_message,
+            AssistantMessage: self._log_assistant_message,
+            UserMessage: self._log_user_message,
+            ResultMessage: self._log_result_message,
+        }
+        self._block_log_handlers = {
+            ToolUseBlock: self._log_tool_use_block,
+            TextBlock: self._log_text_block,
+            ToolResultBlock: self._log_tool_result_block,
+        }
+        logger.info("Agent initialized. Session ID: %s", self.session_id or "None (new session)")
+        logger.debug("MCP Servers config: %s", MCP_SERVERS)
 
     def _load_session_id(self) -> str | None:
         """Load persisted session ID if it exists."""
-        if SESSION_FILE.exists():
+        try:
             sid = SESSION_FILE.read_text().strip()
-            return sid if sid else None
-        return None
+        except FileNotFoundError:
+            return None
+        return sid or None
 
     def _save_session_id(self, session_id: str):
-        """Persist session ID for future runs."""
-        SESSION_FILE.write_text(session_id)
+        """Persist session ID for future runs (skipped if unchanged)."""
+        if session_id == self.session_id:
+            return
+        # Write to a temp file and rename so a crash can't leave a partial ID
+        tmp_file = SESSION_FILE.with_suffix(".tmp")
+        tmp_file.write_text(session_id)
+        os.replace(tmp_file, SESSION_FILE)
         self.session_id = session_id
 
     def _handle_stderr(self, message: str):
         """Log stderr output from the SDK/MCP servers."""
         # Log at debug level to avoid cluttering console, but capture in file
-        logger.debug(f"SDK STDERR: {message.rstrip()}")
+        logger.debug("SDK STDERR: %s", message.rstrip())
 
-    def _get_options(self) -> ClaudeAgentOptions:
-        """Build options for the agent, including session resume if available."""
+    def _build_base_options(self) -> ClaudeAgentOptions:
+        """Build the session-independent options for the agent (no resume)."""
         # Combine external MCP servers with in-process SDK servers
         all_mcp_servers = {
             **MCP_SERVERS,
@@ -175,7 +215,7 @@ class HangoutAgent:
             mcp_servers=all_mcp_servers,
             model="claude-opus-4-5-20251101",
             max_turns=None,  # Let Claude decide when it's done with this iteration
-            resume=self.session_id,
+            resume=None,
             fork_session=False,  # Direct resume - let compaction manage context size
             permission_mode="default",  # Use default mode - hooks handle auto-approval
             stderr=self._handle_stderr,  # Capture SDK/MCP stderr output
@@ -210,6 +250,19 @@ class HangoutAgent:
             cwd=str(DATA_DIR),
         )
 
+    def _get_options(self) -> ClaudeAgentOptions:
+        """Build options for the agent, including session resume if available.
+
+        Only the resume session ID varies, so the base options are shared and
+        the result is cached until the session ID changes.
+        """
+        if self._cached_options_sid == self.session_id:
+            return self._cached_options
+        options = dataclasses.replace(self._base_options, resume=self.session_id)
+        self._cached_options = options
+        self._cached_options_sid = self.session_id
+        return options
+
     @property
     def is_initialized(self) -> bool:
         """Check if the agent has been initialized (has a session)."""
@@ -235,11 +288,19 @@ class HangoutAgent:
                 await self.interrupt()
             await self._client.__aexit__(None, None, None)
         except Exception as e:
-            logger.warning(f"Error during client cleanup: {e}")
+            logger.warning("Error during client cleanup: %s", e)
         finally:
             self._client = None
+            await close_http_session()
             logger.info("Agent client stopped")
 
+    async def __aenter__(self) -> "HangoutAgent":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.stop()
+
     async def interrupt(self):
         """Interrupt any active query. Call this on shutdown signals."""
         if self._client and self._query_in_progress:
@@ -248,7 +309,7 @@ class HangoutAgent:
                 await self._client.interrupt()
                 logger.info("Interrupt sent successfully")
             except Exception as e:
-                logger.warning(f"Error sending interrupt: {e}")
+                logger.warning("Error sending interrupt: %s", e)
 
     async def run_diagnostics(self):
         """Run Discord connectivity diagnostics."""
@@ -267,8 +328,7 @@ class HangoutAgent:
         Only used as a last resort when context is full and compaction doesn't help.
         """
         logger.warning("Restarting client for fresh session (MCP servers will restart)")
-        if SESSION_FILE.exists():
-            SESSION_FILE.unlink()
+        SESSION_FILE.unlink(missing_ok=True)
         self.session_id = None
 
         # Stop the old client
@@ -276,7 +336,7 @@ class HangoutAgent:
             try:
                 await self._client.__aexit__(None, None, None)
             except Exception as e:
-                logger.warning(f"Error stopping old client: {e}")
+                logger.warning("Error stopping old client: %s", e)
             self._client = None
 
         # Create fresh client - _get_options() will have resume=None now
@@ -300,35 +360,34 @@ class HangoutAgent:
                 self._log_message(msg)
                 if isinstance(msg, ResultMessage):
                     if msg.is_error:
-                        logger.error(f"Compaction returned error: {msg}")
+                        logger.error("Compaction returned error: %s", msg)
                         return False
                     self._save_session_id(msg.session_id)
-                    logger.info(f"Compaction complete. New session: {msg.session_id[:12]}...")
+                    logger.info("Compaction complete. New session: %.12s...", msg.session_id)
                     return True
         except Exception as e:
-            logger.error(f"Compaction failed with exception: {e}")
+            logger.error("Compaction failed with exception: %s", e)
             return False
         return False  # No ResultMessage received
 
-    async def _run_query(self, prompt: str, _retried: bool = False):
+    async def _run_query(self, prompt: str):
         """Execute a query, handling prompt-too-long errors with restart.
 
         Runs compaction after every successful query to keep context manageable.
         If prompt-too-long error occurs, immediately restarts with fresh session
         since the context is already at capacity and can't accept /compact command.
         """
-        result = await self._execute_query(prompt)
-
-        # Check if we hit a "prompt too long" error
-        if result.get("prompt_too_long"):
-            if _retried:
+        for attempt in range(2):
+            result = await self._execute_query(prompt)
+            if not result.get("prompt_too_long"):
+                break
+            if attempt:
                 # Already retried once - give up to avoid infinite loop
                 logger.error("Prompt still too long after restart - giving up")
                 return
             # Context is full - can't even send /compact, so restart immediately
             logger.warning("Prompt too long - restarting client with fresh session")
             await self._restart_client()
-            return await self._run_query(prompt, _retried=True)
 
         # Proactively compact after every successful query to prevent overflow
         logger.info("Running post-query compaction...")
@@ -337,10 +396,11 @@ class HangoutAgent:
     async def _execute_query(self, prompt: str) -> dict:
         """Execute a single query attempt with inactivity monitoring.
 
-        Uses per-message timeout instead of global timeout. If no messages
-        arrive for INACTIVITY_TIMEOUT_SECONDS, raises asyncio.TimeoutError.
+        Uses an inactivity timeout instead of a global timeout: it is extended
+        every time a message arrives. If no messages arrive for
+        INACTIVITY_TIMEOUT_SECONDS, raises TimeoutError.
         """
-        logger.info(f"Query prompt ({len(prompt)} chars): {prompt[:100]}...")
+        logger.info("Query prompt (%d chars): %.100s...", len(prompt), prompt)
         result = {"prompt_too_long": False}
 
         if self._client is None:
@@ -349,33 +409,38 @@ class HangoutAgent:
         self._query_in_progress = True
         try:
             await self._client.query(prompt)
-            response_iter = self._client.receive_response()
-
-            while True:
-                try:
-                    # Wait for next message with inactivity timeout
-                    msg = await asyncio.wait_for(
-                        response_iter.__anext__(),
-                        timeout=INACTIVITY_TIMEOUT_SECONDS
-                    )
+            loop = asyncio.get_running_loop()
+
+            # One inactivity timeout for the whole response, pushed back each
+            # time a message arrives. TimeoutError propagates up to caller.
+            async with asyncio.timeout(INACTIVITY_TIMEOUT_SECONDS) as inactivity:
+                async for msg in self._client.receive_response():
+                    inactivity.reschedule(loop.time() + INACTIVITY_TIMEOUT_SECONDS)
                     self._log_message(msg)
 
                     if isinstance(msg, ResultMessage):
                         self._save_session_id(msg.session_id)
-                        logger.info(f"Session: {msg.session_id[:12]}... | Turns: {msg.num_turns} | Cost: ${msg.total_cost_usd:.4f}")
-                        print(f"\n[Session: {msg.session_id[:12]}... | Turns: {msg.num_turns}]")
+                        # The console log handler shows this too, so no separate print()
+                        if logger.isEnabledFor(logging.INFO):
+                            logger.info(
+                                "Session: %.12s... | Turns: %s | Cost: $%.4f",
+                                msg.session_id, msg.num_turns, msg.total_cost_usd,
+                            )
                         break
                     elif isinstance(msg, AssistantMessage):
+                        text_parts = []
                         for block in msg.content:
                             if isinstance(block, TextBlock):
-                                print(block.text)
-                                # Detect "prompt too long" error
-                                if "prompt is too long" in block.text.lower():
+                                text_parts.append(block.text)
+                                # Detect "prompt too long" error (once is enough)
+                                if not result["prompt_too_long"] and _PROMPT_TOO_LONG_RE.search(block.text, 0, _PROMPT_TOO_LONG_SCAN_CHARS):
                                     result["prompt_too_long"] = True
                                     logger.error("Detected 'prompt is too long' error")
-                except StopAsyncIteration:
-                    break
-                # asyncio.TimeoutError propagates up to caller
+                        if text_parts:
+                            # One write + flush per message instead of a print() per block
+                            text_parts.append("")
+                            sys.stdout.write("\n".join(text_parts))
+                            sys.stdout.flush()
         finally:
             self._query_in_progress = False
 
@@ -383,54 +448,78 @@ class HangoutAgent:
 
     def _log_message(self, msg):
         """Log detailed information about each message from the SDK."""
-        if isinstance(msg, SystemMessage):
-            logger.debug(f"SystemMessage: subtype={msg.subtype}")
-            if msg.subtype == "init" and hasattr(msg, "data"):
-                tools = msg.data.get("tools", [])
+        handler = self._log_handlers.get(type(msg))
+        if handler is not None:
+            handler(msg)
+
+    def _log_system_message(self, msg: SystemMessage):
+        debug_on = logger.isEnabledFor(logging.DEBUG)
+        if debug_on:
+            logger.debug("SystemMessage: subtype=%s", msg.subtype)
+        data = getattr(msg, "data", None)
+        if msg.subtype == "init" and data is not None and logger.isEnabledFor(logging.INFO):
+            tools = data.get("tools", ())
+            if debug_on:
                 mcp_tools = [t for t in tools if t.startswith("mcp__")]
-                logger.info(f"Available MCP tools: {len(mcp_tools)} tools")
-                logger.debug(f"MCP tools list: {mcp_tools}")
-
-        elif isinstance(msg, AssistantMessage):
-            for block in msg.content:
-                if isinstance(block, ToolUseBlock):
-                    # Check if this is a sub-agent invocation
-                    if block.name == "Task" and isinstance(block.input, dict):
-                        subagent = block.input.get("subagent_type", "unknown")
-                        desc = block.input.get("description", "")
-                        logger.info(f"SUBAGENT CALL: {subagent} - {desc}")
-                    else:
-                        logger.info(f"TOOL CALL: {block.name}")
-                    logger.debug(f"  Input: {block.input}")
-                elif isinstance(block, TextBlock):
-                    # Log first 200 chars of assistant text
-                    preview = block.text[:200] + "..." if len(block.text) > 200 else block.text
-                    logger.debug(f"Assistant text: {preview}")
-
-        elif isinstance(msg, UserMessage):
-            for block in msg.content:
-                if isinstance(block, ToolResultBlock):
-                    # This is where tool results come back - critical for debugging!
-                    content = block.content
-                    is_error = getattr(block, "is_error", False)
-
-                    if is_error:
-                        logger.error(f"TOOL ERROR: {content}")
-                    else:
-                        # Log tool result, truncating if very long
-                        if isinstance(content, str):
-                            preview = content[:500] + "..." if len(content) > 500 else content
-                        elif isinstance(content, list):
-                            # MCP tools often return list of content blocks
-                            preview = str(content)[:500] + "..." if len(str(content)) > 500 else str(content)
-                        else:
-                            preview = str(content)[:500]
-                        logger.info(f"TOOL RESULT: {preview}")
-
-        elif isinstance(msg, ResultMessage):
-            logger.info(f"Query complete: turns={msg.num_turns}, cost=${msg.total_cost_usd:.4f}, error={msg.is_error}")
-            if hasattr(msg, "usage"):
-                logger.debug(f"Token usage: {msg.usage}")
+                logger.info("Available MCP tools: %d tools", len(mcp_tools))
+                logger.debug("MCP tools list: %s", mcp_tools)
+            else:
+                # Only the count is logged, so don't materialize the list
+                count = sum(1 for t in tools if t.startswith("mcp__"))
+                logger.info("Available MCP tools: %d tools", count)
+
+    def _log_assistant_message(self, msg: AssistantMessage):
+        # Skip per-block work for levels no handler will consume
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        self._log_blocks(msg.content)
+
+    def _log_user_message(self, msg: UserMessage):
+        self._log_blocks(msg.content)
+
+    def _log_blocks(self, blocks):
+        """Dispatch each content block to its handler by exact type."""
+        handlers = self._block_log_handlers
+        for block in blocks:
+            handler = handlers.get(type(block))
+            if handler is not None:
+                handler(block)
+
+    def _log_tool_use_block(self, block: ToolUseBlock):
+        tool_input = block.input
+        # Check if this is a sub-agent invocation
+        if block.name == "Task" and isinstance(tool_input, dict):
+            subagent = tool_input.get("subagent_type", "unknown")
+            desc = tool_input.get("description", "")
+            logger.info("SUBAGENT CALL: %s - %s", subagent, desc)
+        else:
+            logger.info("TOOL CALL: %s", block.name)
+        # %r is rendered lazily, only if a DEBUG handler emits the record
+        logger.debug("  Input: %r", tool_input)
+
+    def _log_text_block(self, block: TextBlock):
+        if logger.isEnabledFor(logging.DEBUG):
+            # Log first 200 chars of assistant text
+            logger.debug("Assistant text: %s", _preview(block.text, 200))
+
+    def _log_tool_result_block(self, block: ToolResultBlock):
+        # This is where tool results come back - critical for debugging!
+        content = block.content
+        if getattr(block, "is_error", False):
+            logger.error("TOOL ERROR: %s", content)
+        else:
+            # Log tool result, truncating if very long (MCP tools often
+            # return a list of content blocks, stringified on demand)
+            logger.info("TOOL RESULT: %s", _Truncated(content, 500))
+
+    def _log_result_message(self, msg: ResultMessage):
+        logger.info(
+            "Query complete: turns=%s, cost=$%.4f, error=%s",
+            msg.num_turns, msg.total_cost_usd, msg.is_error,
+        )
+        usage = getattr(msg, "usage", None)
+        if usage is not None:
+            logger.debug("Token usage: %r", usage)
 
     async def run_iteration(self):
         """Run a single iteration of the main loop."""
@@ -4,6 +4,13 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Environment settings (read once at import)
+DISCORD_MCP_PATH = os.getenv("DISCORD_MCP_PATH", "/path/to/discord-mcp/dist/index.js")
+DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN", "")
+ALLOW_GUILD_IDS = os.getenv("ALLOW_GUILD_IDS", "")
+ALLOW_CHANNEL_IDS = os.getenv("ALLOW_CHANNEL_IDS", "")
+GATEWAY_INTENTS = os.getenv("GATEWAY_INTENTS", str((1 << 0) | (1 << 1) | (1 << 9) | (1 << 10) | (1 << 15)))  # Guilds | GuildMembers | GuildMessages | MessageReactions | MessageContent
+
 # Paths
 DATA_DIR = Path("data")
 SESSION_FILE = DATA_DIR / "session_id"
@@ -13,6 +20,10 @@ MCP_LOG_FILE = DATA_DIR / "mcp-discord.log"
 # Loop timing
 ITERATION_DELAY_SECONDS = 3
 
+# Back off exponentially (with jitter) after consecutive failed iterations,
+# capped at this many seconds
+MAX_ERROR_BACKOFF_SECONDS = 30
+
 # Inactivity timeout - if no messages arrive from the SDK for this long, consider it hung
 INACTIVITY_TIMEOUT_SECONDS = 600  # 10 minutes between messages
 
@@ -23,13 +34,13 @@ MCP_SERVERS = {
         "command": "bash",
         "args": [
             str(Path(__file__).parent / "mcp-wrapper.sh"),
-            os.getenv("DISCORD_MCP_PATH", "/path/to/discord-mcp/dist/index.js"),
+            DISCORD_MCP_PATH,
         ],
         "env": {
-            "DISCORD_BOT_TOKEN": os.getenv("DISCORD_BOT_TOKEN", ""),
-            "ALLOW_GUILD_IDS": os.getenv("ALLOW_GUILD_IDS", ""),
-            "ALLOW_CHANNEL_IDS": os.getenv("ALLOW_CHANNEL_IDS", ""),
-            "GATEWAY_INTENTS": os.getenv("GATEWAY_INTENTS", str((1 << 0) | (1 << 1) | (1 << 9) | (1 << 10) | (1 << 15))),  # Guilds | GuildMembers | GuildMessages | MessageReactions | MessageContent
+            "DISCORD_BOT_TOKEN": DISCORD_BOT_TOKEN,
+            "ALLOW_GUILD_IDS": ALLOW_GUILD_IDS,
+            "ALLOW_CHANNEL_IDS": ALLOW_CHANNEL_IDS,
+            "GATEWAY_INTENTS": GATEWAY_INTENTS,
             "MCP_LOG_FILE": str(MCP_LOG_FILE),
         },
     }
@@ -46,7 +57,9 @@ SYSTEM_PROMPT = f"""You are Claude, existing in your own space. You have:
   keeping notes about their interests. You can browse and search old message
   history too.
 - The web to browse and explore - use the web_researcher agent for searches and
-  fetching URLs
+  fetching URLs. When you have several independent things to look up, launch
+  one web_researcher Task per topic in a single response so they run in
+  parallel instead of one after another
 - Vision capabilities for images - use mcp__image_tools__fetch_image to view images
 - A notes file ({NOTES_FILE}) for persistent memory that survives context resets
 
@@ -121,7 +134,7 @@ Stay active and keep looping.
 """
 
 # Discord configuration for diagnostics
-DISCORD_GUILD_ID = os.getenv("ALLOW_GUILD_IDS", "").split(",")[0].strip()
+DISCORD_GUILD_ID = ALLOW_GUILD_IDS.split(",")[0].strip()
 
 # Diagnostic prompt - verifies Discord connectivity and sets up Gateway subscription
 DIAGNOSTIC_PROMPT = f"""DIAGNOSTIC CHECK - Please verify Discord connectivity and set up Gateway subscription by running these tests in order:
@@ -144,7 +157,7 @@ DIAGNOSTIC_PROMPT = f"""DIAGNOSTIC CHECK - Please verify Discord connectivity an
    - Are there any error messages?
 
 If anything fails, report the EXACT error message you received and also check
-{MCP_LOG_FILE}". This is critical for debugging.
+{MCP_LOG_FILE}. This is critical for debugging.
 
 When this is done, end the loop and exit."""
 
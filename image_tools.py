@@ -1,20 +1,33 @@
 """Custom MCP tools for image fetching and vision capabilities."""
 
+import asyncio
 import base64
 import io
 import logging
-from typing import Any
+import time
+from collections import OrderedDict
+from typing import Any, NamedTuple
 
 import aiohttp
 from PIL import Image
 
 from claude_agent_sdk import tool, create_sdk_mcp_server
 
+try:
+    # SIMD-accelerated base64, encoding straight to str
+    from pybase64 import b64encode_as_string as b64encode_str
+except ImportError:
+    def b64encode_str(data: bytes) -> str:
+        return base64.b64encode(data).decode("ascii")
+
 logger = logging.getLogger("hangout")
 
 # Maximum raw image size to even attempt downloading (10MB)
 MAX_DOWNLOAD_SIZE = 10 * 1024 * 1024
 
+# Chunk size used when streaming image downloads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 # Maximum dimension (long edge) before resizing
 # Claude auto-downscales images with long edge > 1568px anyway
 # Resizing client-side saves bandwidth and improves TTFT
@@ -23,14 +36,68 @@ MAX_DIMENSION = 1568
 # JPEG quality for resized images
 JPEG_QUALITY = 85
 
+# Payloads larger than this are base64-encoded in a worker thread so the
+# event loop isn't blocked; smaller ones aren't worth the thread hop
+BASE64_THREAD_THRESHOLD = 64 * 1024
+
 # Supported image MIME types
-SUPPORTED_TYPES = {
+SUPPORTED_TYPES = frozenset({
     "image/jpeg",
     "image/png",
     "image/gif",
     "image/webp",
+})
+
+# Content types that don't identify the format; the body is sniffed instead
+GENERIC_CONTENT_TYPES = frozenset({
+    "",
+    "application/octet-stream",
+    "binary/octet-stream",
+})
+
+# Number of leading bytes needed to identify a supported image format
+SNIFF_BYTES = 12
+
+# First two bytes of each supported format -> (MIME type, full signature check),
+# so sniffing dispatches straight to the one candidate format
+_SNIFF_TABLE = {
+    b"\xff\xd8": ("image/jpeg", lambda data: data.startswith(b"\xff\xd8\xff")),
+    b"\x89P": ("image/png", lambda data: data.startswith(b"\x89PNG\r\n\x1a\n")),
+    b"GI": ("image/gif", lambda data: data.startswith((b"GIF87a", b"GIF89a"))),
+    b"RI": ("image/webp", lambda data: data[:4] == b"RIFF" and data[8:12] == b"WEBP"),
 }
 
+# Human-readable list of SUPPORTED_TYPES for error messages
+SUPPORTED_TYPES_TEXT = ", ".join(sorted(SUPPORTED_TYPES))
+
+# How long a successful fetch_image result is reused for the same URL.
+# Discord attachment URLs are signed and point at immutable content, so
+# repeat views within this window skip the download and resize entirely.
+# After that, the entry is revalidated with a conditional GET (ETag /
+# Last-Modified) and reused as-is on 304 Not Modified.
+FETCH_CACHE_TTL_SECONDS = 300
+
+# Maximum number of cached fetch_image results (least recently used evicted)
+FETCH_CACHE_MAX_ENTRIES = 32
+
+# Maximum total size of cached base64 payloads (least recently used evicted)
+FETCH_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class _CachedFetch(NamedTuple):
+    fetched_at: float
+    result: dict[str, Any]
+    validators: dict[str, str]  # Conditional request headers for revalidation
+    size: int  # Length of the base64 payload
+
+
+# LRU cache of successful fetch_image results, keyed by url
+_fetch_cache: OrderedDict[str, _CachedFetch] = OrderedDict()
+_fetch_cache_bytes = 0
+
+# Image modes with a palette or alpha channel, flattened to RGB for JPEG output
+FLATTEN_MODES = frozenset({"RGBA", "LA", "P", "PA"})
+
 # Map MIME types to PIL format names
 MIME_TO_PIL_FORMAT = {
     "image/jpeg": "JPEG",
@@ -40,6 +107,18 @@ MIME_TO_PIL_FORMAT = {
 }
 
 
+def sniff_image_type(data: bytes) -> str | None:
+    """Identify a supported image MIME type from its leading magic bytes.
+
+    Returns None if the data doesn't start like a supported image.
+    """
+    entry = _SNIFF_TABLE.get(bytes(data[:2]))
+    if entry is None:
+        return None
+    mime_type, matches = entry
+    return mime_type if matches(data) else None
+
+
 def resize_image_if_needed(image_data: bytes, content_type: str) -> tuple[bytes, str]:
     """Resize an image if it exceeds MAX_DIMENSION on its long edge.
 
@@ -60,7 +139,13 @@ def resize_image_if_needed(image_data: bytes, content_type: str) -> tuple[bytes,
 
     # If already within limits, return as-is
     if long_edge <= MAX_DIMENSION:
-        logger.info(f"Image {width}x{height} within limits, no resize needed")
+        logger.info("Image %dx%d within limits, no resize needed", width, height)
+        return image_data, content_type
+
+    # Resizing only keeps the first frame (and re-encodes GIFs as JPEG), so
+    # pass animated GIFs through untouched rather than flattening them
+    if content_type == "image/gif" and getattr(img, "is_animated", False):
+        logger.info("Animated GIF %dx%d, skipping resize", width, height)
         return image_data, content_type
 
     # Calculate scale factor to fit within MAX_DIMENSION
@@ -68,11 +153,18 @@ def resize_image_if_needed(image_data: bytes, content_type: str) -> tuple[bytes,
     new_width = int(width * scale)
     new_height = int(height * scale)
 
-    logger.info(f"Resizing image: {width}x{height} -> {new_width}x{new_height}")
+    logger.info("Resizing image: %dx%d -> %dx%d", width, height, new_width, new_height)
 
-    # Convert to RGB if necessary (for JPEG output)
-    if img.mode in ("RGBA", "P"):
-        img = img.convert("RGB")
+    # For JPEGs, let libjpeg decode at a reduced scale (1/2, 1/4 or 1/8) that
+    # still leaves at least 2x the target size for the LANCZOS pass
+    if img.format == "JPEG":
+        img.draft(img.mode, (new_width * 2, new_height * 2))
+
+    # Palette/alpha images are output as JPEG. Go through RGBA so the resize
+    # filters real colors (palette images only support nearest-neighbor).
+    if img.mode in FLATTEN_MODES:
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
         output_format = "JPEG"
         output_mime = "image/jpeg"
     else:
@@ -82,6 +174,13 @@ def resize_image_if_needed(image_data: bytes, content_type: str) -> tuple[bytes,
     # Resize image
     resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
 
+    # JPEG has no alpha: composite onto white (on the smaller, resized image)
+    # instead of dropping the channel, which turns transparent areas black
+    if resized.mode == "RGBA":
+        background = Image.new("RGB", resized.size, (255, 255, 255))
+        background.paste(resized, mask=resized.getchannel("A"))
+        resized = background
+
     # Encode to bytes
     buffer = io.BytesIO()
     if output_format == "JPEG":
@@ -89,12 +188,73 @@ def resize_image_if_needed(image_data: bytes, content_type: str) -> tuple[bytes,
     else:
         resized.save(buffer, format=output_format, optimize=True)
 
-    buffer.seek(0)
-    result_bytes = buffer.read()
-    logger.info(f"Resized: {len(image_data)} -> {len(result_bytes)} bytes")
+    result_bytes = buffer.getvalue()
+    logger.info("Resized: %d -> %d bytes", len(image_data), len(result_bytes))
     return result_bytes, output_mime
 
 
+# Shared HTTP session so connections (and TLS) to the same CDN host are reused
+# across fetch_image calls. Created lazily inside the running event loop.
+_http_session: aiohttp.ClientSession | None = None
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """Return the shared HTTP session, creating it if needed."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            # Fail fast on dead hosts and stalled reads, with an overall cap so
+            # a slow-trickling server can't hold a fetch open indefinitely
+            timeout=aiohttp.ClientTimeout(total=60, connect=5, sock_connect=5, sock_read=10),
+            connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300, keepalive_timeout=60),
+        )
+    return _http_session
+
+
+async def close_http_session() -> None:
+    """Close the shared HTTP session, if one was created."""
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+def _get_cached_entry(url: str) -> _CachedFetch | None:
+    """Return the cached fetch_image entry for url (fresh or stale), if any."""
+    cached = _fetch_cache.get(url)
+    if cached is not None:
+        _fetch_cache.move_to_end(url)
+    return cached
+
+
+def _revalidation_headers(headers: Any) -> dict[str, str]:
+    """Build conditional request headers from a response's cache validators."""
+    validators = {}
+    etag = headers.get("etag")
+    if etag:
+        validators["If-None-Match"] = etag
+    last_modified = headers.get("last-modified")
+    if last_modified:
+        validators["If-Modified-Since"] = last_modified
+    return validators
+
+
+def _cache_result(url: str, result: dict[str, Any], validators: dict[str, str], now: float) -> None:
+    """Store a successful fetch_image result, evicting LRU entries over the caps."""
+    global _fetch_cache_bytes
+    size = len(result["content"][0]["data"])
+    previous = _fetch_cache.pop(url, None)
+    if previous is not None:
+        _fetch_cache_bytes -= previous.size
+    if size > FETCH_CACHE_MAX_BYTES:
+        return
+    _fetch_cache[url] = _CachedFetch(now, result, validators, size)
+    _fetch_cache_bytes += size
+    while len(_fetch_cache) > FETCH_CACHE_MAX_ENTRIES or _fetch_cache_bytes > FETCH_CACHE_MAX_BYTES:
+        _, evicted = _fetch_cache.popitem(last=False)
+        _fetch_cache_bytes -= evicted.size
+
+
 @tool(
     "fetch_image",
     "Fetch an image from a URL and return it for visual analysis. "
@@ -120,78 +280,118 @@ async def fetch_image(args: dict[str, Any]) -> dict[str, Any]:
             "is_error": True,
         }
 
-    logger.info(f"FetchImage: Fetching {url[:100]}...")
+    now = time.monotonic()
+    cached = _get_cached_entry(url)
+    if cached is not None and now - cached.fetched_at < FETCH_CACHE_TTL_SECONDS:
+        logger.info("FetchImage: Cache hit for %.100s...", url)
+        return cached.result
+
+    logger.info("FetchImage: Fetching %.100s...", url)
 
     try:
-        timeout = aiohttp.ClientTimeout(total=30)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    error_msg = f"Failed to fetch image: HTTP {response.status}"
-                    logger.warning(f"FetchImage: {error_msg}")
-                    return {
-                        "content": [{"type": "text", "text": error_msg}],
-                        "is_error": True,
-                    }
+        session = _get_session()
+        # Revalidate a stale entry instead of re-downloading it
+        request_headers = cached.validators if cached is not None else None
+        async with session.get(url, headers=request_headers) as response:
+            if response.status == 304 and cached is not None:
+                logger.info("FetchImage: Not modified, reusing cached image")
+                _cache_result(url, cached.result, cached.validators, now)
+                return cached.result
+
+            if response.status != 200:
+                error_msg = f"Failed to fetch image: HTTP {response.status}"
+                logger.warning("FetchImage: %s", error_msg)
+                return {
+                    "content": [{"type": "text", "text": error_msg}],
+                    "is_error": True,
+                }
 
-                # Check content type
-                content_type = response.headers.get("content-type", "").split(";")[0].strip()
-                if content_type not in SUPPORTED_TYPES:
-                    error_msg = f"Unsupported content type: {content_type}. Supported: {', '.join(SUPPORTED_TYPES)}"
-                    logger.warning(f"FetchImage: {error_msg}")
-                    return {
-                        "content": [{"type": "text", "text": error_msg}],
-                        "is_error": True,
-                    }
+            # Check content type (generic types are resolved by sniffing below)
+            content_type = response.headers.get("content-type", "").partition(";")[0].strip()
+            if content_type not in SUPPORTED_TYPES and content_type not in GENERIC_CONTENT_TYPES:
+                error_msg = f"Unsupported content type: {content_type}. Supported: {SUPPORTED_TYPES_TEXT}"
+                logger.warning("FetchImage: %s", error_msg)
+                return {
+                    "content": [{"type": "text", "text": error_msg}],
+                    "is_error": True,
+                }
 
-                # Check content length if available (reject very large downloads)
-                content_length = response.headers.get("content-length")
-                if content_length and int(content_length) > MAX_DOWNLOAD_SIZE:
-                    error_msg = f"Image too large to download: {int(content_length)} bytes (max {MAX_DOWNLOAD_SIZE})"
-                    logger.warning(f"FetchImage: {error_msg}")
-                    return {
-                        "content": [{"type": "text", "text": error_msg}],
-                        "is_error": True,
-                    }
+            # Check content length if available (reject very large downloads).
+            # aiohttp's parser has already validated and parsed the header.
+            content_length = response.content_length
+            if content_length is not None and content_length > MAX_DOWNLOAD_SIZE:
+                error_msg = f"Image too large to download: {content_length} bytes (max {MAX_DOWNLOAD_SIZE})"
+                logger.warning("FetchImage: %s", error_msg)
+                return {
+                    "content": [{"type": "text", "text": error_msg}],
+                    "is_error": True,
+                }
 
-                # Read image data
-                image_data = await response.read()
-                if len(image_data) > MAX_DOWNLOAD_SIZE:
-                    error_msg = f"Image too large: {len(image_data)} bytes (max {MAX_DOWNLOAD_SIZE})"
-                    logger.warning(f"FetchImage: {error_msg}")
+            # Stream image data, aborting as soon as it exceeds the limit
+            # (Content-Length may be missing or wrong)
+            buffer = bytearray()
+            magic_checked = False
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                buffer.extend(chunk)
+                if len(buffer) > MAX_DOWNLOAD_SIZE:
+                    error_msg = f"Image too large: over {MAX_DOWNLOAD_SIZE} bytes"
+                    logger.warning("FetchImage: %s", error_msg)
                     return {
                         "content": [{"type": "text", "text": error_msg}],
                         "is_error": True,
                     }
-
-                # Resize if needed (images > 1568px long edge)
-                image_data, content_type = resize_image_if_needed(image_data, content_type)
-
-                # Encode as base64
-                base64_data = base64.b64encode(image_data).decode("utf-8")
-                logger.info(f"FetchImage: Success - {len(image_data)} bytes, {content_type}")
-
-                # Return image content for Claude's vision
+                # Stop downloading as soon as the magic bytes show it isn't an image
+                if not magic_checked and len(buffer) >= SNIFF_BYTES:
+                    magic_checked = True
+                    if sniff_image_type(buffer) is None:
+                        break
+
+            # Trust the file's magic bytes over the advertised content type
+            sniffed_type = sniff_image_type(buffer)
+            if sniffed_type is None:
+                error_msg = f"Content is not a supported image (advertised as {content_type or 'unknown'})"
+                logger.warning("FetchImage: %s", error_msg)
                 return {
-                    "content": [
-                        {
-                            "type": "image",
-                            "data": base64_data,
-                            "mimeType": content_type,
-                        }
-                    ]
+                    "content": [{"type": "text", "text": error_msg}],
+                    "is_error": True,
                 }
+            content_type = sniffed_type
+            image_data = bytes(buffer)
+
+            # Resize if needed (images > 1568px long edge). PIL decode/resize/
+            # encode is CPU-bound, so run it off the event loop.
+            image_data, content_type = await asyncio.to_thread(resize_image_if_needed, image_data, content_type)
+
+            # Encode as base64
+            if len(image_data) > BASE64_THREAD_THRESHOLD:
+                base64_data = await asyncio.to_thread(b64encode_str, image_data)
+            else:
+                base64_data = b64encode_str(image_data)
+            logger.info("FetchImage: Success - %d bytes, %s", len(image_data), content_type)
+
+            # Return image content for Claude's vision
+            result = {
+                "content": [
+                    {
+                        "type": "image",
+                        "data": base64_data,
+                        "mimeType": content_type,
+                    }
+                ]
+            }
+            _cache_result(url, result, _revalidation_headers(response.headers), now)
+            return result
 
     except aiohttp.ClientError as e:
         error_msg = f"Network error fetching image: {e}"
-        logger.error(f"FetchImage: {error_msg}")
+        logger.error("FetchImage: %s", error_msg)
         return {
             "content": [{"type": "text", "text": error_msg}],
             "is_error": True,
         }
     except Exception as e:
         error_msg = f"Unexpected error fetching image: {e}"
-        logger.error(f"FetchImage: {error_msg}")
+        logger.error("FetchImage: %s", error_msg)
         return {
             "content": [{"type": "text", "text": error_msg}],
             "is_error": True,
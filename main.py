@@ -6,17 +6,27 @@ Run with: python main.py
 """
 
 import asyncio
+import atexit
 import logging
+import logging.handlers
+import queue
+import random
 import signal
 import sys
 
-import anyio
+try:
+    # Faster drop-in event loop (not available on Windows)
+    import uvloop
+except ImportError:
+    uvloop = None
 
 from agent import HangoutAgent
-from config import ITERATION_DELAY_SECONDS, DATA_DIR
+from config import ITERATION_DELAY_SECONDS, MAX_ERROR_BACKOFF_SECONDS, DATA_DIR
 
 # Set up logging
 LOG_FILE = DATA_DIR / "agent.log"
+LOG_MAX_BYTES = 16 * 1024 * 1024  # Rotate agent.log at this size
+LOG_BACKUP_COUNT = 3  # Keep agent.log.1 .. agent.log.3
 
 
 def setup_logging():
@@ -27,6 +37,11 @@ def setup_logging():
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
+    # The formatter doesn't use thread/process fields, so skip collecting them
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
     # Root logger for our app
     logger = logging.getLogger("hangout")
     logger.setLevel(logging.DEBUG)
@@ -35,16 +50,26 @@ def setup_logging():
     console_handler = logging.StreamHandler(sys.stderr)
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
 
-    # File handler - DEBUG level (full detail)
+    # File handler - DEBUG level (full detail), rotated so it can't grow forever
     DATA_DIR.mkdir(parents=True, exist_ok=True)
-    file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
 
-    logger.info(f"Logging initialized. Log file: {LOG_FILE}")
+    # The logger only enqueues records; a background thread does the actual
+    # console/file writes so they never block the event loop
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(
+        log_queue, console_handler, file_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)  # Flushes queued records on exit
+
+    logger.info("Logging initialized. Log file: %s", LOG_FILE)
     return logger
 
 
@@ -57,24 +82,32 @@ async def main():
 
     agent = HangoutAgent()
 
-    # Handle graceful shutdown
+    # Handle graceful shutdown. Installed before the agent starts so a signal
+    # during (possibly slow) startup still goes through cleanup.
     shutdown_event = asyncio.Event()
     loop = asyncio.get_running_loop()
+    interrupt_tasks = set()  # Strong references; the loop only keeps weak ones
 
-    def signal_handler(sig, _frame):
-        logger.info(f"Received signal {sig}, shutting down...")
+    def request_shutdown(sig):
+        # Runs as a normal callback on the event loop, not in signal context
+        logger.info("Received signal %s, shutting down...", sig.name)
         print("\n\nShutting down gracefully...")
         shutdown_event.set()
-        # Schedule interrupt of any active query (async call from sync handler)
-        loop.call_soon_threadsafe(lambda: loop.create_task(agent.interrupt()))
-
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
-    # Start the agent (initializes long-lived client and MCP servers)
-    await agent.start()
-
-    try:
+        # Interrupt any active query
+        task = loop.create_task(agent.interrupt())
+        interrupt_tasks.add(task)
+        task.add_done_callback(interrupt_tasks.discard)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_shutdown, sig)
+        except NotImplementedError:
+            # Windows event loops don't support add_signal_handler
+            signal.signal(sig, lambda signum, _frame: loop.call_soon_threadsafe(request_shutdown, signal.Signals(signum)))
+
+    # Start the agent (initializes long-lived client and MCP servers). The client
+    # is reused for every query and always cleaned up (stops MCP servers) on exit.
+    async with agent:
         # Run diagnostics to verify Discord connectivity
         logger.info("Running Discord diagnostics...")
         print("\n=== Running Discord Diagnostics ===\n")
@@ -85,36 +118,43 @@ async def main():
             await agent.initialize()
 
         # Main loop
-        logger.info(f"Starting main loop (delay: {ITERATION_DELAY_SECONDS}s between iterations)")
+        logger.info("Starting main loop (delay: %ss between iterations)", ITERATION_DELAY_SECONDS)
         print(f"\nStarting main loop (delay: {ITERATION_DELAY_SECONDS}s between iterations)")
         print("Press Ctrl+C to stop\n")
 
         iteration_count = 0
+        consecutive_failures = 0
+        # Created once and reused as the wake-up for every inter-iteration wait
+        shutdown_task = asyncio.create_task(shutdown_event.wait())
         while not shutdown_event.is_set():
             iteration_count += 1
-            logger.info(f"--- Iteration {iteration_count} ---")
+            logger.info("--- Iteration %d ---", iteration_count)
+            delay = ITERATION_DELAY_SECONDS
             try:
                 await agent.run_iteration()
+                consecutive_failures = 0
             except Exception as e:
-                logger.exception(f"Error in iteration {iteration_count}: {e}")
+                logger.exception("Error in iteration %d: %s", iteration_count, e)
                 print(f"\n[Error in iteration: {e}]")
-                # Continue running despite errors
+                # Continue running despite errors, backing off on repeated failures
+                consecutive_failures += 1
+                retry_after = getattr(e, "retry_after", None)
+                if isinstance(retry_after, (int, float)) and retry_after > 0:
+                    delay = retry_after
+                else:
+                    delay = min(
+                        MAX_ERROR_BACKOFF_SECONDS,
+                        ITERATION_DELAY_SECONDS * 2 ** (consecutive_failures - 1) + random.uniform(0, 1),
+                    )
+                logger.info("Retrying in %.1fs (consecutive failures: %d)", delay, consecutive_failures)
 
             # Wait before next iteration, but allow early exit on shutdown
-            try:
-                await asyncio.wait_for(
-                    shutdown_event.wait(),
-                    timeout=ITERATION_DELAY_SECONDS,
-                )
-            except asyncio.TimeoutError:
-                pass  # Normal case - timeout means continue to next iteration
-    finally:
-        # Always clean up the client (stops MCP servers)
-        await agent.stop()
+            await asyncio.wait({shutdown_task}, timeout=delay)
 
     logger.info("Agent stopped.")
     print("Agent stopped.")
 
 
 if __name__ == "__main__":
-    anyio.run(main)
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+        runner.run(main())